@@ -1,28 +1,152 @@
 # Sabrina Yang, Sitong Xu
-import math, os, re
-from typing import Tuple, List, Dict
+import os, re
+from collections import Counter
+from functools import lru_cache
+from multiprocessing import Pool
+from types import MappingProxyType
+from typing import Tuple, List, Dict, Optional, Mapping
 import chardet
+import numpy as np
+from scipy.sparse import csr_matrix, csc_matrix
+from scipy.sparse.linalg import norm
+
+_TOKEN_RE = re.compile(r"([a-zA-Z0-9'_-]+)|(\S)")
+
+
+def tokenize(text: str) -> Dict[str, int]:
+    """Splits given text into a list of the individual tokens and counts them
+
+    Args:
+        text - text to tokenize
+
+    Returns:
+        a dictionary mapping tokens from the input text to the number of times
+        they occurred
+    """
+    # words are runs of letters, digits, ' _ and -; any other non-whitespace character is its own token
+    tokens = [word.lower() if word else symbol for word, symbol in _TOKEN_RE.findall(text)]
+
+    # make a dictionary mapping tokens to counts
+    return dict(Counter(tokens))
+
+
+@lru_cache(maxsize=1024)
+def _tokenize_query(query: str) -> Mapping[str, int]:
+    """Tokenizes a query, remembering recent queries so repeats skip the regex pass.
+
+    Args:
+        query - query text to tokenize
+
+    Returns:
+        a read-only view of tokenize(query), since the cached mapping is shared between calls
+    """
+    return MappingProxyType(tokenize(query))
+
+
+def _read_text(path: str) -> str:
+    """Reads a text file, trying utf-8 and then cp1252 before falling back to chardet's guess.
+
+    Args:
+        path - path to the file to read
+
+    Returns:
+        the decoded text of the file
+    """
+    # one open and one read; every decoding attempt below works on the bytes in memory
+    with open(path, 'rb') as f:
+        raw_data = f.read()
+
+    # utf-8-sig decodes plain utf-8 identically but also drops a leading byte order mark
+    for encoding in ('utf-8-sig', 'cp1252'):
+        try:
+            text = raw_data.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            pass
+    else:
+        # only pay for chardet's statistical scan when neither common encoding fits
+        encoding = chardet.detect(raw_data)['encoding'] or 'utf-8'
+        text = raw_data.decode(encoding, errors='ignore')
+
+    # match the newline translation that reading in text mode used to do
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def _ingest(path: str) -> Optional[Tuple[str, Dict[str, int]]]:
+    """Reads and tokenizes one corpus file. Runs in a worker process, so it lives at module level.
+
+    Args:
+        path - path to the file to read
+
+    Returns:
+        a (preview, terms) tuple, where preview is the first 500 characters of the text,
+        or None if the file could not be read
+    """
+    try:
+        text = _read_text(path)
+        return text[:500], tokenize(text)
+    except Exception as e:
+        print(f"Error reading file {os.path.basename(path)}: {e}")
+        return None
+
 
 class Document:
     """The Document class.
-        Attributes: text - the text of the document
+        Attributes: preview - the first 500 characters of the document
+                    path - the file the document was read from, or None if it has no file
+                    text - the text of a document built in memory (e.g. a query); documents read from a
+                           file keep only preview and path, see full_text
                     terms - a dictionary mapping words to the number of times they occur in the document
                          - please note that this sort of dictionary is returned by tokenize
-                    term_vector - an ordered list of tfidf values for each term. The length of this list
-                                  will be the same for all documents in a corpus.
+                    term_vector - a 1 x |V| sparse row of L2-normalized tfidf values for each term. The
+                                  width of this row will be the same for all documents in a corpus.
+                                  For corpus documents it is sliced on demand from the engine's doc_matrix,
+                                  so the weights are only stored once.
     """
 
     def __init__(self):
         """Creates an empty document.
         """
         self.text = ""
+        self.preview = ""
+        self.path = None
         self.terms = {}
-        self.term_vector = []
+        self._term_vector = None
+        self._matrix_row = None
 
     def __str__(self):
         """Returns the first 500 characters in the document as a preview.
         """
-        return self.text[:500]
+        if self.path is None:
+            return self.text[:500]
+        return self.preview
+
+    @property
+    def term_vector(self):
+        """Returns the document's tfidf row, slicing it from the shared matrix if it has one.
+        """
+        if self._matrix_row is not None:
+            matrix, row = self._matrix_row
+            return matrix[row]
+        return self._term_vector
+
+    @term_vector.setter
+    def term_vector(self, vector):
+        self._term_vector = vector
+        self._matrix_row = None
+
+    def use_matrix_row(self, matrix: csc_matrix, row: int):
+        """Makes term_vector read row `row` of `matrix` instead of holding its own copy.
+        """
+        self._term_vector = None
+        self._matrix_row = (matrix, row)
+
+    def full_text(self) -> str:
+        """Returns the whole text of the document, re-reading and decoding its file if it has one.
+        """
+        if self.path is None:
+            return self.text
+        return _read_text(self.path)
 
 
 class TFIDF_Engine:
@@ -33,6 +157,10 @@ class TFIDF_Engine:
                     df_table - a dictionary mapping words to the number of documents they occurred in
                     term_vector_words - an ordered list of the unique words in the corpus. This list
                                 will dictate the order of the scores in each document.term_vector
+                    term_index - a dictionary mapping each word to its column in term_vector_words
+                    idf - an array of idf values, aligned with term_vector_words
+                    doc_matrix - an N x |V| sparse float32 matrix whose rows are the documents' term vectors,
+                                 stored column-major (CSC) so each column is the posting list of one word
     """
 
     def __init__(self):
@@ -41,6 +169,9 @@ class TFIDF_Engine:
         self.N = 0
         self.df_table = {}
         self.term_vector_words = []
+        self.term_index = {}
+        self.idf = np.empty(0)
+        self.doc_matrix = csc_matrix((0, 0))
 
     def __str__(self):
         s = "corpus has: " + str(self.N) + " documents\n"
@@ -50,35 +181,27 @@ class TFIDF_Engine:
 
     def read_files(self):
         try:
-            # Get all files in the directory
-            files = next(os.walk(self.corpus_location))[2]
-
-            # Filter out hidden files and optionally check for a specific file extension (e.g., .txt)
-            files = [file for file in files if not file.startswith('.') and file.endswith('.txt')]
+            # Get all .txt files in the directory, skipping hidden files and subdirectories
+            with os.scandir(self.corpus_location) as entries:
+                paths = [entry.path for entry in entries
+                         if entry.name.endswith('.txt') and not entry.name.startswith('.') and entry.is_file()]
 
             # Debugging: Print the number of files found after filtering
-            print(f"Number of files after filtering: {len(files)}")
+            print(f"Number of files after filtering: {len(paths)}")
 
-            if len(files) != 122:
+            if len(paths) != 122:
                 print("Warning: The number of documents does not match the expected count.")
 
-            for file in files:
-                path = os.path.join(self.corpus_location, file)
-                try:
-                    with open(path, 'rb') as f:
-                        raw_data = f.read()
-                        result = chardet.detect(raw_data)
-                        encoding = result['encoding']
-
-                    with open(path, 'r', encoding=encoding, errors='ignore') as f:
-                        text = f.read()
+            # read and tokenize the files in parallel, one file per task
+            with Pool() as pool:
+                results = pool.map(_ingest, paths)
 
+            for path, result in zip(paths, results):
+                if result is not None:
                     doc = Document()
-                    doc.text = text
-                    doc.terms = self.tokenize(text)
+                    doc.path = path
+                    doc.preview, doc.terms = result
                     self.documents.append(doc)
-                except Exception as e:
-                    print(f"Error reading file {file}: {e}")
 
             self.N = len(self.documents)
 
@@ -86,50 +209,90 @@ class TFIDF_Engine:
             print(f"Error setting up the file reading process: {e}")
 
     def create_df_table(self):
+        df_counts = Counter()
         for doc in self.documents:
-            for term in doc.terms:
-                if term in self.df_table:
-                    self.df_table[term] += 1
-                else:
-                    self.df_table[term] = 1
+            # count each term once per document, not by its number of occurrences
+            df_counts.update(doc.terms.keys())
+        self.df_table = dict(df_counts)
         self.term_vector_words = list(self.df_table.keys())
+        self.term_index = {term: i for i, term in enumerate(self.term_vector_words)}
+        self.idf = np.log(self.N / np.array(list(self.df_table.values()), dtype=float))
+
+    def build_term_matrix(self, docs: List[Document]) -> csr_matrix:
+        """Builds a sparse matrix with one L2-normalized tfidf row per document.
+
+        Args:
+            docs - the documents to vectorize; terms outside the corpus vocabulary are skipped
+
+        Returns:
+            a len(docs) x |V| csr_matrix holding only the nonzero tfidf entries
+        """
+        rows, cols, counts = [], [], []
+        for row, d in enumerate(docs):
+            for term, count in d.terms.items():
+                col = self.term_index.get(term)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+                    counts.append(count)
+
+        # tf * idf for every entry at once, reading the idf values cached by create_df_table
+        cols = np.array(cols, dtype=np.intp)
+        data = (1 + np.log(np.array(counts, dtype=float))) * self.idf[cols]
+        # float32 is ample precision for ranking and halves the memory the matvec streams through
+        m = csr_matrix((data.astype(np.float32), (rows, cols)), shape=(len(docs), len(self.term_vector_words)),
+                       dtype=np.float32)
+        # scale each row to unit length in place; rows whose weights are all 0 (e.g. only idf-0 terms) stay 0
+        norms = norm(m, axis=1)
+        norms[norms == 0] = 1
+        m.data /= np.repeat(norms, np.diff(m.indptr))
+        return m
 
     def create_term_vector(self, d: Document):
-        d.term_vector = []
-        for term in self.term_vector_words:
-            if term in d.terms:
-                tf = 1 + math.log(d.terms[term])
-                idf = math.log(self.N / self.df_table[term])
-                d.term_vector.append(tf * idf)
-            else:
-                d.term_vector.append(0)
+        d.term_vector = self.build_term_matrix([d])
 
     def create_term_vectors(self):
-        for doc in self.documents:
-            self.create_term_vector(doc)
+        self.doc_matrix = self.build_term_matrix(self.documents).tocsc()
+        for idx, doc in enumerate(self.documents):
+            doc.use_matrix_row(self.doc_matrix, idx)
 
     def calculate_cosine_sim(self, d1: Document, d2: Document) -> float:
-        dot_product = sum(a * b for a, b in zip(d1.term_vector, d2.term_vector))
-        magnitude_d1 = math.sqrt(sum(a * a for a in d1.term_vector))
-        magnitude_d2 = math.sqrt(sum(b * b for b in d2.term_vector))
-        if magnitude_d1 == 0 or magnitude_d2 == 0:
-            return 0
-        return dot_product / (magnitude_d1 * magnitude_d2)
-
-    def get_results(self, query: str):
+        # term vectors are unit length, so the dot product is the cosine similarity
+        return float(d1.term_vector.multiply(d2.term_vector).sum())
+
+    def get_results(self, query: str, k: Optional[int] = None) -> List[Tuple[float, int]]:
+        """Scores every document against the query.
+
+        Args:
+            query - the query text
+            k - if given, only the k best results are selected and returned
+
+        Returns:
+            a list of (similarity, document index) tuples, best match first
+        """
         query_doc = Document()
         query_doc.text = query
-        query_doc.terms = self.tokenize(query)
+        query_doc.terms = _tokenize_query(query)
         self.create_term_vector(query_doc)
 
-        results = []
-        for idx, doc in enumerate(self.documents):
-            similarity = self.calculate_cosine_sim(query_doc, doc)
-            results.append((similarity, idx))
-
-        # Sorting the results by similarity score in descending order
-        results.sort(key=lambda x: x[0], reverse=True)
-        return results
+        # the query row holds only its own few terms, and doc_matrix.T is a free CSR view of the
+        # CSC matrix, so the product only walks the posting lists of the query's terms
+        scores = (query_doc.term_vector @ self.doc_matrix.T).toarray().ravel()
+
+        # Ranking the documents by similarity score in descending order
+        if k is None or k >= len(scores):
+            ranking = np.argsort(-scores, kind="stable")
+        elif k <= 0:
+            return []
+        else:
+            # find the k-th best score in linear time, keep everything above it and fill the
+            # remaining slots with the lowest-index ties, then order just those k documents
+            cutoff = -np.partition(-scores, k - 1)[k - 1]
+            above = np.flatnonzero(scores > cutoff)
+            tied = np.flatnonzero(scores == cutoff)[:k - len(above)]
+            top = np.concatenate((above, tied))
+            ranking = top[np.lexsort((top, -scores[top]))]
+        return [(float(scores[idx]), int(idx)) for idx in ranking]
 
     def query_loop(self):
         """Asks the user for a query. Utilizes self.get_results. Prints the top 5 results.
@@ -140,10 +303,10 @@ class TFIDF_Engine:
             try:
                 print()
                 query = input("Query: ")
-                sim_scores = self.get_results(query)
+                sim_scores = self.get_results(query, 5)
                 # display the top 5 results
                 print("RESULTS\n")
-                for i in range(5):
+                for i in range(len(sim_scores)):
                     print("\nresult number " + str(i) + " has score " + str(sim_scores[i][0]))
                     print(self.documents[sim_scores[i][1]])
 
@@ -153,44 +316,9 @@ class TFIDF_Engine:
         print("\nSo long!\n")
 
     def tokenize(self, text: str) -> Dict[str, int]:
-        """Splits given text into a list of the individual tokens and counts them
-
-        Args:
-            text - text to tokenize
-
-        Returns:
-            a dictionary mapping tokens from the input text to the number of times
-            they occurred
+        """Splits given text into a list of the individual tokens and counts them. See tokenize.
         """
-        tokens = []
-        token = ""
-        for c in text:
-            if (
-                    re.match("[a-zA-Z0-9]", str(c)) != None
-                    or c == "'"
-                    or c == "_"
-                    or c == "-"
-            ):
-                token += c
-            else:
-                if token != "":
-                    tokens.append(token.lower())
-                    token = ""
-                if c.strip() != "":
-                    tokens.append(str(c.strip()))
-
-        if token != "":
-            tokens.append(token.lower())
-
-        # make a dictionary mapping tokens to counts
-        d_tokens = {}
-        for t in tokens:
-            if t in d_tokens:
-                d_tokens[t] += 1
-            else:
-                d_tokens[t] = 1
-
-        return d_tokens
+        return tokenize(text)
 
 
 # Optional Challenge:
@@ -207,7 +335,7 @@ if __name__ == "__main__":
     t.read_files()
 
     assert t.N == 122, "read files N test"
-    assert t.documents[5].text != "", "read files document text test"
+    assert t.documents[5].full_text() != "", "read files document text test"
     assert t.documents[100].terms != {}, "read files document terms test"
     assert isinstance(t.documents[9].terms["the"], int), "read files document terms structure test"
 
@@ -221,7 +349,7 @@ if __name__ == "__main__":
     # # create the document vector for each document
     t.create_term_vectors()
     #
-    assert len(t.documents[10].term_vector) == len(t.term_vector_words), "create_term_vectors test"
+    assert t.documents[10].term_vector.shape[1] == len(t.term_vector_words), "create_term_vectors test"
 
     # # tests for calculate_cosine_sim
     assert t.calculate_cosine_sim(t.documents[0], t.documents[1]) > 0, "calculate_cosine_sim test 1"
@@ -231,10 +359,10 @@ if __name__ == "__main__":
     # # tests for get_results
     assert t.get_results("star wars")[0][1] == 111, "get_results test 1"
     assert "Lucas announces new 'Star Wars' title" in t.documents[
-        t.get_results("star wars")[0][1]].text, "get_results test 1"
+        t.get_results("star wars")[0][1]].full_text(), "get_results test 1"
     assert t.get_results("movie trek george lucas")[2][1] == 24, "get_results test 2"
     assert "Stars of 'X-Men' film are hyped, happy, as comic heroes" in t.documents[
-        t.get_results("movie trek george lucas")[2][1]].text
+        t.get_results("movie trek george lucas")[2][1]].full_text()
     assert len(t.get_results("star trek")) == len(t.documents), "get_results test 3"
     #
     # t.query_loop() #uncomment this line to try out the search engine